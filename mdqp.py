@@ -2,75 +2,212 @@
 
 import datetime
 import hashlib
+import io
+import json
 import logging
 import os
+import re
 import shutil
+import sqlite3
 import sys
 import tempfile
+import threading
+import time
 import xml.etree.ElementTree as ET
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
 
 import requests
 from persistqueue import SQLiteQueue
-from pathlib import Path
 
 
-def sha1sum(filename):
-    h = hashlib.sha1()
-    b = bytearray(128 * 1024)
-    mv = memoryview(b)
-    with open(filename, "rb", buffering=0) as f:
-        for n in iter(lambda: f.readinto(mv), 0):
-            h.update(mv[:n])
-    return h.hexdigest()
+def read_and_hash(filename):
+    with open(filename, "rb") as f:
+        data = f.read()
+    return data, hashlib.sha1(data).hexdigest()
 
 
-def download_signed_metadata(mdq, destination_dir, shasum):
-    baseurl = f"{mdq}/entities/" + "%7Bsha1%7D"
-    metadata_url = f"{baseurl}{shasum}"
-    response = requests.get(metadata_url)
-    if response.status_code != 200:
-        raise SystemExit(
-            f"mdq returned {response.status_code} (for {metadata_url}) better die here - please investigate"
-        )
+_LOCAL = threading.local()
 
-    if "Content-Type" not in response.headers:
-        raise SystemExit(
-            f"mdq returned no content-type (for {metadata_url}) better die here - please investigate"
-        )
 
-    if not response.headers["Content-Type"].startswith("application/xml"):
-        raise SystemExit(
-            f'mdq returned invalid ({response.headers["Content-Type"]}) content-type (for {metadata_url}) better die here - please investigate'
-        )
+def read_buffer(size):
+    # One buffer per thread, reused across files
+    buf = getattr(_LOCAL, "buf", None)
+    if buf is None or len(buf) < size:
+        buf = _LOCAL.buf = memoryview(bytearray(size))
+    return buf[:size]
 
-    # Ensure fully downloaded files in signed_metadata_dir
-    with tempfile.NamedTemporaryFile(delete=False) as tmp:
-        tmp.write(response.content)
 
-    metadata_tree = xml_to_tree(tmp.name)
-    if not metadata_tree:
-        raise SystemExit(
-            f"mdq returned invalid XML (for {metadata_url}) better die here - please investigate"
-        )
+def equal_by_streaming(data, filename, bufsize=1024 * 1024):
+    # Compare data with the content of filename, stopping at the first
+    # block that differs. Files that fit the buffer take a single read.
+    buf = read_buffer(bufsize)
+    offset = 0
+    with open(filename, "rb", buffering=0) as f:
+        for n in iter(lambda: f.readinto(buf), 0):
+            if not data.startswith(buf[:n], offset):
+                return False
+            offset += n
+    return offset == len(data)
 
-    entityid = get_entityid(metadata_tree)
-    if not entityid:
-        raise SystemExit(
-            f"mdq returned metadata without entityid (for {metadata_url}) better die here - please investigate"
-        )
-    shutil.move(tmp.name, destination_dir + "/%7Bsha1%7D" + shasum)
 
+MAX_PARALLEL_DOWNLOADS = 32
+CLASSIFY_BATCH_SIZE = 1000
+
+_SESSION = requests.Session()
+_ADAPTER = requests.adapters.HTTPAdapter(pool_connections=16, pool_maxsize=64)
+_SESSION.mount("https://", _ADAPTER)
+_SESSION.mount("http://", _ADAPTER)
 
-def get_entityid_from_file(file):
-    metadata = xml_to_tree(file)
-    entityid = None
 
-    if metadata:
-        entityid = get_entityid(metadata)
+def write_metadata(dst, data):
+    # data is the content of the incoming file as read and hashed, so the
+    # seen copy always matches the sha1 recorded for it. Not hardlinked,
+    # reflinked or copied in the kernel (copy_file_range) from the incoming
+    # file since upstream may have rewritten it since.
+    fd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        mv = memoryview(data)
+        while mv:
+            mv = mv[os.write(fd, mv) :]
+    finally:
+        os.close(fd)
+
+
+def download_signed_metadata(mdq, destination_dir, validators_dir, shasum):
+    baseurl = f"{mdq}/entities/" + "%7Bsha1%7D"
+    metadata_url = f"{baseurl}{shasum}"
+    destination = destination_dir + "/%7Bsha1%7D" + shasum
+    validators_file = validators_dir + "/" + shasum
+
+    # Conditional GET using the ETag/Last-Modified of the copy we have
+    headers = {}
+    if os.path.exists(destination):
+        try:
+            with open(validators_file) as f:
+                headers = json.load(f)
+        except (OSError, ValueError):
+            # Missing or unreadable, just do a full GET
+            headers = {}
+
+    # Don't leave partial downloads behind in the published directory
+    tmp = None
+    try:
+        with _SESSION.get(
+            metadata_url, headers=headers, stream=True, timeout=(5, 30)
+        ) as response:
+            if response.status_code == 304:
+                logging.debug("%s not modified", metadata_url)
+                return
+
+            if response.status_code != 200:
+                raise SystemExit(
+                    f"mdq returned {response.status_code} (for {metadata_url}) better die here - please investigate"
+                )
+
+            if "Content-Type" not in response.headers:
+                raise SystemExit(
+                    f"mdq returned no content-type (for {metadata_url}) better die here - please investigate"
+                )
+
+            if not response.headers["Content-Type"].startswith("application/xml"):
+                raise SystemExit(
+                    f'mdq returned invalid ({response.headers["Content-Type"]}) content-type (for {metadata_url}) better die here - please investigate'
+                )
+
+            # Ensure fully downloaded files in signed_metadata_dir. The temporary
+            # file lives next to its destination so the move is a plain rename.
+            response.raw.decode_content = True
+            with tempfile.NamedTemporaryFile(
+                dir=destination_dir, prefix=".", delete=False
+            ) as tmp:
+                shutil.copyfileobj(response.raw, tmp, length=1024 * 1024)
+
+            validators = {}
+            if "ETag" in response.headers:
+                validators["If-None-Match"] = response.headers["ETag"]
+            if "Last-Modified" in response.headers:
+                validators["If-Modified-Since"] = response.headers["Last-Modified"]
+
+        metadata_tree = xml_to_tree(tmp.name)
+        if not metadata_tree:
+            raise SystemExit(
+                f"mdq returned invalid XML (for {metadata_url}) better die here - please investigate"
+            )
+
+        entityid = get_entityid(metadata_tree)
+        if not entityid:
+            raise SystemExit(
+                f"mdq returned metadata without entityid (for {metadata_url}) better die here - please investigate"
+            )
+        shutil.move(tmp.name, destination)
+    except BaseException:
+        if tmp is not None and os.path.exists(tmp.name):
+            os.unlink(tmp.name)
+        raise
+
+    # Written to a temporary file and moved into place, so a run dying
+    # half-way never leaves a truncated sidecar behind
+    if validators:
+        with tempfile.NamedTemporaryFile(
+            "w", dir=validators_dir, prefix=".", delete=False
+        ) as f:
+            json.dump(validators, f)
+        os.replace(f.name, validators_file)
     else:
+        # The same shasum can be fetched twice in a run, from both the new
+        # and the delta queue
+        try:
+            os.remove(validators_file)
+        except FileNotFoundError:
+            pass
+
+
+# Root EntityDescriptor start tag up to its entityID, after an optional
+# BOM, XML declaration, processing instructions and comments. Attributes
+# are matched whole so text inside an earlier value can't match. Values
+# needing unescaping or normalisation are left to the XML parser.
+# Comments and processing instructions can't run past their terminator, so
+# a prolog can only be split one way and a failing match stays linear.
+ENTITYID_RE = re.compile(
+    rb"(?:\xef\xbb\xbf)?\s*"
+    rb"(?:(?:<\?(?:[^?]|\?(?!>))*\?>|<!--(?:[^-]|-(?!->))*-->)\s*)*"
+    rb"<((?:[\w.-]+:)?EntityDescriptor)"
+    rb"(?:\s+[\w:.-]+\s*=\s*(?:\"[^\"]*\"|'[^']*'))*?"
+    rb"\s+entityID\s*=\s*([\"'])([^\"'&<\x00-\x1f\x7f-\xff]+)\2"
+)
+
+
+# Only for content already known to parse, such as files in seen_metadata
+# which were parsed before being promoted. It doesn't check the document is
+# well-formed, so incoming files must go through the parser. Returns None
+# when in doubt.
+def get_entityid_fast(data):
+    match = ENTITYID_RE.match(data, 0, 4096)
+    if match and data.rstrip().endswith(b"</" + match.group(1) + b">"):
+        return match.group(3).decode("ascii")
+
+    return None
+
+
+# Only used on files in seen_metadata
+def get_entityid_from_file(file):
+    with open(file, "rb") as f:
+        data = f.read()
+
+    entityid = get_entityid_fast(data)
+    if entityid:
+        return entityid
+
+    return get_entityid_from_bytes(data, file)
+
+
+def get_entityid_from_bytes(data, file):
+    metadata = xml_to_tree(io.BytesIO(data), file)
+    if not metadata:
         return None
 
-    return entityid
+    return get_entityid(metadata)
 
 
 def get_entityid(parsed_metadata):
@@ -81,16 +218,16 @@ def get_entityid(parsed_metadata):
     try:
         entityid = root.attrib["entityID"]
     except KeyError:
-        logging.warn(f"No entityID found")
+        logging.warning("No entityID found")
 
     return entityid
 
 
-def xml_to_tree(file):
+def xml_to_tree(source, file=None):
     try:
-        tree = ET.parse(file)
+        tree = ET.parse(source)
     except ET.ParseError:
-        logging.error(f"Can't parse {file}")
+        logging.error(f"Can't parse {file or source}")
         return None
 
     return tree
@@ -103,6 +240,188 @@ def shasum_entityid(entityid):
     return entityid_sha
 
 
+def open_seen_index(path):
+    conn = sqlite3.connect(path)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(
+        """CREATE TABLE IF NOT EXISTS seen (
+            filename TEXT PRIMARY KEY,
+            entityid TEXT,
+            entity_sha TEXT,
+            sha1 TEXT,
+            size INTEGER,
+            mtime_ns INTEGER,
+            ctime_ns INTEGER,
+            ino INTEGER
+        )"""
+    )
+    return conn
+
+
+# key is the indexed_stat_key() of the incoming file the seen copy was made
+# from, taken before it was read
+def update_seen_index(conn, filename, entityid, entity_sha, sha1, key):
+    conn.execute(
+        """INSERT INTO seen (
+            filename, entityid, entity_sha, sha1, size, mtime_ns, ctime_ns, ino
+        )
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT(filename) DO UPDATE SET
+            entityid = excluded.entityid,
+            entity_sha = excluded.entity_sha,
+            sha1 = excluded.sha1,
+            size = excluded.size,
+            mtime_ns = excluded.mtime_ns,
+            ctime_ns = excluded.ctime_ns,
+            ino = excluded.ino""",
+        (filename, entityid, entity_sha, sha1, *key),
+    )
+
+
+# SQLiteQueue internals put_many() and ack_through() rely on (persist-queue 0.8)
+QUEUE_INTERNALS = (
+    "cursor",
+    "tran_lock",
+    "_putter",
+    "_serializer",
+    "_sql_insert",
+    "total",
+    "put_event",
+)
+
+
+def check_queue_internals(queue):
+    missing = [name for name in QUEUE_INTERNALS if not hasattr(queue, name)]
+    if missing:
+        raise SystemExit(
+            f"SQLiteQueue lacks {', '.join(missing)} needed by put_many()/ack_through() - persist-queue changed? better die here - please investigate"
+        )
+
+
+def put_many(queue, messages):
+    # SQLiteQueue.put() commits once per item. Insert the whole batch in one
+    # transaction instead, the same way put() does it (persist-queue 0.8).
+    if not messages:
+        return
+    rows = [(queue._serializer.dumps(m), time.time()) for m in messages]
+    with queue.tran_lock:
+        with queue._putter as tran:
+            tran.executemany(queue._sql_insert, rows)
+    queue.total += len(rows)
+    queue.put_event.set()
+
+
+def ack_through(queue, pqid):
+    # task_done() deletes every message up to the cursor, which is the last
+    # one taken from the queue. Move it back to acknowledge only up to pqid.
+    queue.cursor = pqid
+    queue.task_done()
+
+
+# ctime can't be set from userspace, so a rewrite that restores size and mtime
+# (rsync -a, cp -p) still changes the key
+def stat_key(st):
+    return (st.st_size, st.st_mtime_ns, st.st_ctime_ns, st.st_ino)
+
+
+RACY_WINDOW_NS = 2 * 10**9
+
+
+# A file changed shortly before the run may be rewritten again within the same
+# timestamp tick as our stat, keeping its key while the content differs (git's
+# "racily clean" problem). Such files are indexed without a key, so the next
+# run reads and hashes them again.
+def indexed_stat_key(st, run_start_ns):
+    if max(st.st_mtime_ns, st.st_ctime_ns) > run_start_ns - RACY_WINDOW_NS:
+        return (None, None, None, None)
+    return stat_key(st)
+
+
+# Only reads from disk so it can run in a worker thread. Returns None for
+# unchanged entities, else the queue tag, the message, the content, its sha1
+# and the incoming stat taken before reading. A queue tag of None means the
+# file equals its seen copy and only the index needs updating.
+# The entityID (and its sha1) is only worked out for those entities.
+def classify_entity(entry, seen_entries, entity_info, full_sync):
+    entity = entry.name
+    incoming_file = entry.path
+    seen_entry = seen_entries.get(entity)
+    # Stat before reading, a later rewrite then shows up as a changed stat
+    incoming_stat = entry.stat()
+    _, seen_sha, seen_stat_key = entity_info.get(entity, (None, None, None))
+
+    if full_sync:
+        queue_tag = "daily"
+    elif seen_entry is None:
+        queue_tag = "new"
+    elif seen_stat_key == stat_key(incoming_stat):
+        return None
+    else:
+        queue_tag = "delta"
+
+    # Read once, the same bytes are compared, parsed and written to seen
+    incoming_data, incoming_sha = read_and_hash(incoming_file)
+
+    # Changed files
+    if queue_tag == "delta":
+        if seen_sha:
+            modified = incoming_sha != seen_sha
+        else:
+            # Not in the seen index, compare with the seen copy directly
+            modified = not equal_by_streaming(incoming_data, seen_entry.path)
+        if not modified:
+            # Same content but not indexed with this stat, e.g. seen before
+            # the index existed or touched without being changed
+            queue_tag = None
+
+    if queue_tag is None:
+        # The seen copy was parsed before it was promoted
+        entityid = get_entityid_fast(incoming_data) or get_entityid_from_bytes(
+            incoming_data, incoming_file
+        )
+    else:
+        entityid = get_entityid_from_bytes(incoming_data, incoming_file)
+    if not entityid:
+        logging.warning(f"Can go further with {entity} due to parsing errors")
+        return None
+
+    message_to_enqueue = dict(
+        file=entity,
+        entityid=entityid,
+        shasum=shasum_entityid(entityid),
+    )
+
+    if queue_tag is None:
+        return None, message_to_enqueue, None, incoming_sha, incoming_stat
+
+    if queue_tag == "daily":
+        logging.debug("Boostrap of %s", entity)
+    elif queue_tag == "new":
+        logging.debug("New file %s", entity)
+    else:
+        logging.debug("Modified file %s", entity)
+
+    return queue_tag, message_to_enqueue, incoming_data, incoming_sha, incoming_stat
+
+
+def fetch_entity(
+    queue_str, message, mdq, incoming_dir, signed_metadata_dir, validators_dir
+):
+    shasum = message["shasum"]
+    entityid = message["entityid"]
+    file = message["file"]
+    logging.info(
+        f"Working on message from the {queue_str} queue: {entityid} - {shasum}"
+    )
+    if os.path.exists(incoming_dir + "/" + file):
+        download_signed_metadata(mdq, signed_metadata_dir, validators_dir, shasum)
+    else:
+        logging.info(
+            f"{file} not available in {incoming_dir} - probably removed by upstream"
+        )
+
+
 def main():
     BASEDIR = os.environ["BASEDIR"]
     MDQ_SERVICE = os.environ["MDQ_SERVICE"]
@@ -112,6 +431,7 @@ def main():
     if "MIN_ENTITIES_PER_RUN" in os.environ:
         MIN_ENTITIES_PER_RUN = int(os.environ["MIN_ENTITIES_PER_RUN"])
 
+    run_start_ns = time.time_ns()
     now = datetime.datetime.now()
     hour = now.hour
 
@@ -121,8 +441,10 @@ def main():
     incoming_dir = f"{BASEDIR}/incoming_metadata"
     seen_metadata_dir = f"{BASEDIR}/seen_metadata"
     signed_metadata_dir = f"{BASEDIR}/signed_metadata/entities"
+    validators_dir = f"{BASEDIR}/signed_metadata_validators"
     queues_dir = f"{BASEDIR}/queue"
     full_sync_file = f"{BASEDIR}/full_sync"
+    seen_index_file = f"{BASEDIR}/seen_index.sqlite"
 
     full_sync = False
     if not os.path.exists(full_sync_file):
@@ -133,7 +455,7 @@ def main():
         if os.path.exists(queues_dir):
             shutil.rmtree(queues_dir)
 
-    for dir in [incoming_dir, signed_metadata_dir, seen_metadata_dir]:
+    for dir in [incoming_dir, signed_metadata_dir, seen_metadata_dir, validators_dir]:
         if not os.path.isdir(dir):
             os.makedirs(dir)
     # Merge queues when or if priority is added to persistqueue?
@@ -141,51 +463,102 @@ def main():
     queue_delta = SQLiteQueue(f"{queues_dir}/delta_queue", auto_commit=False)
     queue_new = SQLiteQueue(f"{queues_dir}/new_queue", auto_commit=False)
 
-    for entity in os.listdir(incoming_dir):
-        incoming_file = incoming_dir + "/" + entity
-        entityid = get_entityid_from_file(incoming_file)
-
-        if not entityid:
-            logging.warning(f"Can go further with {entity} due to parsing errors")
-            continue
-
-        message_to_enqueue = dict(
-            file=entity,
-            entityid=entityid,
-            shasum=shasum_entityid(entityid),
+    queues = dict(daily=queue_daily, delta=queue_delta, new=queue_new)
+    for queue in queues.values():
+        check_queue_internals(queue)
+    seen_index = open_seen_index(seen_index_file)
+    # filename -> (entity_sha, sha1, stat_key) of everything in
+    # seen_metadata, kept up to date as files are promoted
+    entity_info = {
+        row[0]: (row[1], row[2], tuple(row[3:]))
+        for row in seen_index.execute(
+            """SELECT filename, entity_sha, sha1, size, mtime_ns, ctime_ns, ino
+            FROM seen"""
         )
-
-        if full_sync:
-            logging.info(f"Boostrap of {entity}")
-            queue_daily.put(message_to_enqueue)
-            shutil.copyfile(incoming_file, seen_metadata_dir + "/" + entity)
-            continue
-
-        # new file
-        if not os.path.isfile(seen_metadata_dir + "/" + entity):
-            logging.info(f"New file {entity}")
-            queue_new.put(message_to_enqueue)
-            shutil.copyfile(incoming_file, seen_metadata_dir + "/" + entity)
-            continue
-
-        # Changed files
-        incoming_sha = sha1sum(incoming_dir + "/" + entity)
-        published_sha = sha1sum(seen_metadata_dir + "/" + entity)
-        if incoming_sha != published_sha:
-            logging.info(f"Modified file {entity}")
-            queue_delta.put(message_to_enqueue)
-            shutil.copyfile(incoming_file, seen_metadata_dir + "/" + entity)
-            continue
+    }
+
+    with os.scandir(incoming_dir) as it:
+        entries = list(it)
+    # seen_metadata as it was before this run, looked up instead of stat'ed
+    with os.scandir(seen_metadata_dir) as it:
+        seen_entries = {entry.name: entry for entry in it}
+
+    # Classified in batches, so at most one batch worth of incoming file
+    # contents is held in memory at a time
+    counts = dict(daily=0, delta=0, new=0)
+    with ThreadPoolExecutor(max_workers=min(32, (os.cpu_count() or 1) * 4)) as pool:
+        for start in range(0, len(entries), CLASSIFY_BATCH_SIZE):
+            batch = entries[start : start + CLASSIFY_BATCH_SIZE]
+            results = pool.map(
+                lambda entry: classify_entity(
+                    entry, seen_entries, entity_info, full_sync
+                ),
+                batch,
+            )
+            results = [
+                (entry, result) for entry, result in zip(batch, results) if result
+            ]
+
+            # Queues, seen_metadata and the index are only touched from this
+            # thread. Messages are committed before anything is promoted, so a
+            # failure in between leads to a duplicate fetch rather than a
+            # missed one.
+            to_enqueue = dict(daily=[], delta=[], new=[])
+            for entry, (queue_tag, message_to_enqueue, *_) in results:
+                if queue_tag is not None:
+                    to_enqueue[queue_tag].append(message_to_enqueue)
+            for queue_tag, messages in to_enqueue.items():
+                put_many(queues[queue_tag], messages)
+                counts[queue_tag] += len(messages)
+
+            for entry, result in results:
+                queue_tag, message_to_enqueue, data, sha1, incoming_stat = result
+                key = indexed_stat_key(incoming_stat, run_start_ns)
+                if queue_tag is not None:
+                    write_metadata(seen_metadata_dir + "/" + entry.name, data)
+                update_seen_index(
+                    seen_index,
+                    entry.name,
+                    message_to_enqueue["entityid"],
+                    message_to_enqueue["shasum"],
+                    sha1,
+                    key,
+                )
+                entity_info[entry.name] = (message_to_enqueue["shasum"], sha1, key)
+            seen_index.commit()
 
     # removed files
-    for entity in os.listdir(seen_metadata_dir):
-        if not os.path.exists(incoming_dir + "/" + entity):
-            entityid = get_entityid_from_file(seen_metadata_dir + "/" + entity)
+    # Files promoted above are all in incoming, so only the entries from
+    # before this run need checking
+    incoming_entities = {entry.name for entry in entries}
+    removed = 0
+    for entity, entry in seen_entries.items():
+        if entity in incoming_entities:
+            continue
+        if entity in entity_info:
+            entity_sha = entity_info.pop(entity)[0]
+        else:
+            # Seen before the index existed
+            entityid = get_entityid_from_file(entry.path)
             entity_sha = shasum_entityid(entityid)
-            logging.info(f"Removed file {entity}: {entity_sha}")
-            os.remove(seen_metadata_dir + "/" + entity)
-            if os.path.exists(signed_metadata_dir + "/%7Bsha1%7D" + entity_sha):
-                os.remove(signed_metadata_dir + "/%7Bsha1%7D" + entity_sha)
+        logging.debug("Removed file %s: %s", entity, entity_sha)
+        removed += 1
+        os.remove(entry.path)
+        seen_index.execute("DELETE FROM seen WHERE filename = ?", (entity,))
+        if os.path.exists(signed_metadata_dir + "/%7Bsha1%7D" + entity_sha):
+            os.remove(signed_metadata_dir + "/%7Bsha1%7D" + entity_sha)
+        if os.path.exists(validators_dir + "/" + entity_sha):
+            os.remove(validators_dir + "/" + entity_sha)
+    seen_index.commit()
+    seen_index.close()
+
+    logging.info(
+        "delta: %d bootstrapped, %d new, %d modified, %d removed",
+        counts["daily"],
+        counts["new"],
+        counts["delta"],
+        removed,
+    )
 
     total_queue_size = queue_daily.size + queue_delta.size + queue_new.size
     logging.info(f"Total queue: {total_queue_size}")
@@ -196,8 +569,8 @@ def main():
 
     operations_this_run = int(total_queue_size / runs_left) + 1 + MIN_ENTITIES_PER_RUN
     logging.info(f"Updates process this run: {operations_this_run}")
-    operations_counter = 0
-    while operations_counter < operations_this_run:
+    fetched = []
+    while len(fetched) < operations_this_run:
         queue_str = ""
         if queue_new.size != 0:
             queue_str = "new"
@@ -211,23 +584,44 @@ def main():
         else:
             logging.info("Queues are empty!")
             break
-        message = queue.get()
-        shasum = message["shasum"]
-        entityid = message["entityid"]
-        file = message["file"]
-        logging.info(
-            f"Working on message from the {queue_str} queue: {entityid} - {shasum}"
-        )
-        if os.path.exists(incoming_dir + "/" + file):
-            download_signed_metadata(MDQ_SERVICE, signed_metadata_dir, shasum)
-        else:
-            logging.info(
-                f"{file} not available in {incoming_dir} - probably removed by upstream"
+        fetched.append((queue_str, queue.get(raw=True)))
+
+    with ThreadPoolExecutor(max_workers=MAX_PARALLEL_DOWNLOADS) as pool:
+        futures = [
+            pool.submit(
+                fetch_entity,
+                queue_str,
+                item["data"],
+                MDQ_SERVICE,
+                incoming_dir,
+                signed_metadata_dir,
+                validators_dir,
             )
-
-        queue.task_done()
-
-        operations_counter += 1
+            for queue_str, item in fetched
+        ]
+
+        # Better die here - don't start the downloads still waiting once one
+        # has failed. Attached after submitting, so the pool can't be shut
+        # down under submit(); futures already done run the callback at once.
+        def stop_on_failure(future):
+            if not future.cancelled() and future.exception() is not None:
+                pool.shutdown(wait=False, cancel_futures=True)
+
+        for future in futures:
+            future.add_done_callback(stop_on_failure)
+
+    # Acknowledge the downloads that succeeded before the first failure, in
+    # the order they were taken from the queues, and re-raise that failure.
+    # Everything from the failed one on, including the downloads cancelled
+    # after it, stays queued for the next run.
+    acked = {}
+    try:
+        for (queue_str, item), future in zip(fetched, futures):
+            future.result()
+            acked[queue_str] = item["pqid"]
+    finally:
+        for queue_str, pqid in acked.items():
+            ack_through(queues[queue_str], pqid)
 
 
 if __name__ == "__main__":
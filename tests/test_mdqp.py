@@ -0,0 +1,450 @@
+import errno
+import gc
+import io
+import json
+import os
+import sqlite3
+import time
+
+import pytest
+
+import mdqp
+
+
+def entity_xml(entityid):
+    return (
+        '<?xml version="1.0"?>\n'
+        '<md:EntityDescriptor xmlns:md="urn:oasis:names:tc:SAML:2.0:metadata"'
+        f' entityID="{entityid}"></md:EntityDescriptor>\n'
+    )
+
+
+@pytest.fixture
+def basedir(tmp_path, monkeypatch):
+    monkeypatch.setenv("BASEDIR", str(tmp_path))
+    monkeypatch.setenv("MDQ_SERVICE", "https://mdq.example.org")
+    monkeypatch.setenv("RPH", "1")
+    monkeypatch.setenv("MIN_ENTITIES_PER_RUN", "1000")
+    (tmp_path / "incoming_metadata").mkdir()
+    return tmp_path
+
+
+@pytest.fixture
+def fetched(monkeypatch):
+    fetched = []
+    monkeypatch.setattr(
+        mdqp,
+        "download_signed_metadata",
+        lambda mdq, destination_dir, validators_dir, shasum: fetched.append(shasum),
+    )
+    return fetched
+
+
+class FakeResponse:
+    def __init__(self, status_code, headers, body=b""):
+        self.status_code = status_code
+        self.headers = headers
+        self.raw = io.BytesIO(body)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+class FakeSession:
+    def __init__(self, *responses):
+        self.responses = list(responses)
+        self.requests = []
+
+    def get(self, url, **kwargs):
+        self.requests.append((url, kwargs.get("headers")))
+        return self.responses.pop(0)
+
+
+def write_entity(basedir, name, entityid):
+    path = basedir / "incoming_metadata" / name
+    path.write_text(entity_xml(entityid))
+    return path
+
+
+def run(fetched):
+    fetched.clear()
+    try:
+        mdqp.main()
+    except SystemExit:
+        pass
+    # Collect the run's queues here rather than in whichever worker thread
+    # the garbage collector happens to run in next, which SQLiteQueue.__del__
+    # can't handle
+    gc.collect()
+    return set(fetched)
+
+
+def sha(entityid):
+    return mdqp.shasum_entityid(entityid)
+
+
+def test_bootstrap_then_unchanged(basedir, fetched):
+    for i in range(3):
+        write_entity(basedir, f"e{i}.xml", f"https://e{i}.example.org")
+
+    assert run(fetched) == {sha(f"https://e{i}.example.org") for i in range(3)}
+    assert sorted(os.listdir(basedir / "seen_metadata")) == [
+        "e0.xml",
+        "e1.xml",
+        "e2.xml",
+    ]
+
+    assert run(fetched) == set()
+
+
+def test_new_modified_removed(basedir, fetched):
+    write_entity(basedir, "keep.xml", "https://keep.example.org")
+    write_entity(basedir, "mod.xml", "https://mod1.example.org")
+    write_entity(basedir, "same.xml", "https://same1.example.org")
+    write_entity(basedir, "gone.xml", "https://gone.example.org")
+    run(fetched)
+
+    signed = basedir / "signed_metadata/entities" / (
+        "%7Bsha1%7D" + sha("https://gone.example.org")
+    )
+    signed.write_text("signed")
+    sidecar = basedir / "signed_metadata_validators" / sha("https://gone.example.org")
+    sidecar.write_text("{}")
+
+    write_entity(basedir, "new.xml", "https://new.example.org")
+    # Same size, but with an older mtime as a restore from backup would give
+    mod = basedir / "incoming_metadata/mod.xml"
+    st = mod.stat()
+    write_entity(basedir, "mod.xml", "https://mod2.example.org")
+    os.utime(mod, ns=(st.st_atime_ns, st.st_mtime_ns - 10**9))
+    # Same size and the very same mtime, as rsync -a or cp -p would leave it
+    same = basedir / "incoming_metadata/same.xml"
+    st = same.stat()
+    write_entity(basedir, "same.xml", "https://same2.example.org")
+    os.utime(same, ns=(st.st_atime_ns, st.st_mtime_ns))
+    os.remove(basedir / "incoming_metadata/gone.xml")
+
+    assert run(fetched) == {
+        sha("https://new.example.org"),
+        sha("https://mod2.example.org"),
+        sha("https://same2.example.org"),
+    }
+    assert sorted(os.listdir(basedir / "seen_metadata")) == [
+        "keep.xml",
+        "mod.xml",
+        "new.xml",
+        "same.xml",
+    ]
+    assert not signed.exists()
+    assert not sidecar.exists()
+
+    assert run(fetched) == set()
+
+
+def test_seen_index_backfilled_for_existing_deployment(basedir, fetched, monkeypatch):
+    # The files are all written just now, index their stat regardless
+    monkeypatch.setattr(mdqp, "RACY_WINDOW_NS", 0)
+    # seen_metadata and full_sync from before the index existed
+    (basedir / "seen_metadata").mkdir()
+    (basedir / "full_sync").touch()
+    for i in range(3):
+        path = write_entity(basedir, f"e{i}.xml", f"https://e{i}.example.org")
+        (basedir / "seen_metadata" / path.name).write_bytes(path.read_bytes())
+
+    assert run(fetched) == set()
+    conn = sqlite3.connect(basedir / "seen_index.sqlite")
+    rows = conn.execute("SELECT filename, entity_sha FROM seen").fetchall()
+    conn.close()
+    assert sorted(rows) == [
+        (f"e{i}.xml", sha(f"https://e{i}.example.org")) for i in range(3)
+    ]
+
+    # Indexed entities are skipped on their stat alone, without comparing
+    # against the seen copy
+    (basedir / "seen_metadata/e0.xml").write_text("stale")
+    assert run(fetched) == set()
+
+
+def test_unindexed_seen_copy_that_differs_is_modified(basedir, fetched):
+    # seen_metadata and full_sync from before the index existed
+    (basedir / "seen_metadata").mkdir()
+    (basedir / "full_sync").touch()
+    for i in range(2):
+        path = write_entity(basedir, f"e{i}.xml", f"https://e{i}.example.org")
+        (basedir / "seen_metadata" / path.name).write_bytes(path.read_bytes())
+    write_entity(basedir, "e1.xml", "https://e1-changed.example.org")
+
+    assert run(fetched) == {sha("https://e1-changed.example.org")}
+    assert (basedir / "seen_metadata/e1.xml").read_bytes() == (
+        basedir / "incoming_metadata/e1.xml"
+    ).read_bytes()
+    assert run(fetched) == set()
+
+
+def test_equal_by_streaming_across_blocks(tmp_path):
+    path = tmp_path / "f"
+    path.write_bytes(b"0123456789")
+
+    assert mdqp.equal_by_streaming(b"0123456789", path, bufsize=4)
+    # Differs in the last, partial, block
+    assert not mdqp.equal_by_streaming(b"012345678X", path, bufsize=4)
+    # One byte short of and one byte longer than the file
+    assert not mdqp.equal_by_streaming(b"012345678", path, bufsize=4)
+    assert not mdqp.equal_by_streaming(b"0123456789X", path, bufsize=4)
+    # Ending on a block boundary
+    assert not mdqp.equal_by_streaming(b"01234567", path, bufsize=4)
+    assert not mdqp.equal_by_streaming(b"", path, bufsize=4)
+
+
+def test_equal_by_streaming_reuses_buffer(tmp_path):
+    long = tmp_path / "long"
+    long.write_bytes(b"abcdefgh")
+    short = tmp_path / "short"
+    short.write_bytes(b"abc")
+
+    # The buffer left from the larger compare must not make the shorter
+    # file look like the data
+    assert mdqp.equal_by_streaming(b"abcdefgh", long, bufsize=16)
+    assert not mdqp.equal_by_streaming(b"abcdefgh", short, bufsize=16)
+    assert not mdqp.equal_by_streaming(b"abcd", short, bufsize=4)
+    assert mdqp.equal_by_streaming(b"abc", short, bufsize=2)
+    assert not mdqp.equal_by_streaming(b"abcdefg", long, bufsize=3)
+    assert mdqp.equal_by_streaming(b"abcdefgh", long, bufsize=3)
+
+
+def test_racily_clean_file_is_read_again(basedir, fetched, monkeypatch):
+    # Timestamps too coarse to tell a rewrite within the same tick apart,
+    # and an upstream that rewrites in place
+    monkeypatch.setattr(
+        mdqp, "stat_key", lambda st: (st.st_size, st.st_mtime_ns, 0, 0)
+    )
+    path = write_entity(basedir, "e.xml", "https://e1.example.org")
+    run(fetched)
+
+    conn = sqlite3.connect(basedir / "seen_index.sqlite")
+    row = conn.execute("SELECT size, mtime_ns, ctime_ns, ino FROM seen").fetchone()
+    conn.close()
+    assert row == (None, None, None, None)
+
+    st = path.stat()
+    write_entity(basedir, "e.xml", "https://e2.example.org")
+    os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns))
+    assert run(fetched) == {sha("https://e2.example.org")}
+
+
+def test_failure_between_enqueue_and_promote(basedir, fetched, monkeypatch):
+    write_entity(basedir, "first.xml", "https://first.example.org")
+    run(fetched)
+
+    entityids = [f"https://new{i}.example.org" for i in range(4)]
+    for i, entityid in enumerate(entityids):
+        write_entity(basedir, f"new{i}.xml", entityid)
+
+    update_seen_index = mdqp.update_seen_index
+    calls = 0
+
+    def failing_update_seen_index(*args):
+        nonlocal calls
+        calls += 1
+        if calls == 3:
+            raise OSError(errno.ENOSPC, "No space left on device")
+        update_seen_index(*args)
+
+    monkeypatch.setattr(mdqp, "update_seen_index", failing_update_seen_index)
+    with pytest.raises(OSError):
+        run(fetched)
+    # Drop the failed run's frames, and with them its open index connection,
+    # as exiting the process would
+    gc.collect()
+    monkeypatch.setattr(mdqp, "update_seen_index", update_seen_index)
+
+    assert run(fetched) == {sha(entityid) for entityid in entityids}
+    assert run(fetched) == set()
+
+
+def test_queue_internals_checked(basedir, fetched, monkeypatch):
+    monkeypatch.setattr(mdqp, "QUEUE_INTERNALS", ("no_such_attribute",))
+    write_entity(basedir, "e.xml", "https://e.example.org")
+    with pytest.raises(SystemExit, match="no_such_attribute"):
+        mdqp.main()
+
+
+def test_failed_download_acknowledges_earlier_ones(basedir, fetched, monkeypatch):
+    monkeypatch.setattr(mdqp, "MAX_PARALLEL_DOWNLOADS", 1)
+    for i in range(4):
+        write_entity(basedir, f"e{i}.xml", f"https://e{i}.example.org")
+    # Messages are queued, and so fetched, in directory order
+    names = os.listdir(basedir / "incoming_metadata")
+    expected = [sha(f"https://{name[:-4]}.example.org") for name in names]
+
+    failing = {expected[1]}
+
+    def failing_download(mdq, destination_dir, validators_dir, shasum):
+        if shasum in failing:
+            raise SystemExit("mdq returned 500")
+        fetched.append(shasum)
+
+    monkeypatch.setattr(mdqp, "download_signed_metadata", failing_download)
+    assert run(fetched) == {expected[0]}
+
+    failing.clear()
+    assert run(fetched) == set(expected[1:])
+    assert run(fetched) == set()
+
+
+def test_failed_download_stops_later_ones(basedir, fetched, monkeypatch):
+    monkeypatch.setattr(mdqp, "MAX_PARALLEL_DOWNLOADS", 1)
+    for i in range(20):
+        write_entity(basedir, f"e{i}.xml", f"https://e{i}.example.org")
+    attempts = []
+
+    def failing_download(mdq, destination_dir, validators_dir, shasum):
+        attempts.append(shasum)
+        raise SystemExit("mdq returned 500")
+
+    monkeypatch.setattr(mdqp, "download_signed_metadata", failing_download)
+    assert run(fetched) == set()
+    assert len(attempts) == 1
+
+    monkeypatch.setattr(
+        mdqp,
+        "download_signed_metadata",
+        lambda mdq, destination_dir, validators_dir, shasum: fetched.append(shasum),
+    )
+    assert run(fetched) == {sha(f"https://e{i}.example.org") for i in range(20)}
+
+
+def test_entityid_fast_path_matches_parser():
+    data = (
+        b'<md:EntityDescriptor xmlns:md="urn:oasis:names:tc:SAML:2.0:metadata"'
+        b" ID=\"_a entityID='https://evil'\" entityID=\"https://real\">"
+        b"</md:EntityDescriptor>"
+    )
+    assert mdqp.get_entityid_fast(data) == "https://real"
+    assert mdqp.get_entityid_from_bytes(data, "test") == "https://real"
+
+
+def test_entityid_truncated_file_is_rejected():
+    data = b'<EntityDescriptor entityID="https://x"><md:SPSSODescriptor'
+    assert mdqp.get_entityid_fast(data) is None
+    assert mdqp.get_entityid_from_bytes(data, "test") is None
+
+
+@pytest.mark.parametrize(
+    "prolog, root",
+    [
+        (
+            "".join(f"<!-- header line {i} -->\n" for i in range(40)),
+            '<EntityDescriptor entityID="https://e.example.org/?a=1&amp;b=2">',
+        ),
+        ("<!-- -->" * 40, "<EntityDescriptor>"),
+        ("<!-- -->" * 40, "<?x"),
+        ("<?x?>" * 40, "<EntityDescriptor>"),
+    ],
+)
+def test_entityid_fast_path_is_linear_in_the_prolog(prolog, root):
+    data = ('<?xml version="1.0"?>\n' + prolog + root + "</EntityDescriptor>").encode()
+    start = time.monotonic()
+    assert mdqp.get_entityid_fast(data) is None
+    assert time.monotonic() - start < 1
+
+
+def test_malformed_incoming_file_is_not_queued(basedir, fetched):
+    # Starts and ends like an EntityDescriptor, but isn't well-formed
+    (basedir / "incoming_metadata/bad.xml").write_text(
+        '<EntityDescriptor entityID="https://bad.example.org">'
+        "<SPSSODescriptor></EntityDescriptor>\n"
+    )
+    write_entity(basedir, "good.xml", "https://good.example.org")
+
+    assert run(fetched) == {sha("https://good.example.org")}
+    assert os.listdir(basedir / "seen_metadata") == ["good.xml"]
+
+
+@pytest.fixture
+def download_dirs(tmp_path):
+    destination_dir = tmp_path / "entities"
+    validators_dir = tmp_path / "validators"
+    destination_dir.mkdir()
+    validators_dir.mkdir()
+    return destination_dir, validators_dir
+
+
+def download(download_dirs, shasum="abc"):
+    destination_dir, validators_dir = download_dirs
+    mdqp.download_signed_metadata(
+        "https://mdq.example.org", str(destination_dir), str(validators_dir), shasum
+    )
+
+
+def xml_response(headers, body=None):
+    if body is None:
+        body = entity_xml("https://e.example.org").encode()
+    return FakeResponse(200, {"Content-Type": "application/xml", **headers}, body)
+
+
+def test_download_then_not_modified(download_dirs, monkeypatch):
+    destination_dir, validators_dir = download_dirs
+    session = FakeSession(
+        xml_response({"ETag": '"v1"'}),
+        FakeResponse(304, {}),
+    )
+    monkeypatch.setattr(mdqp, "_SESSION", session)
+
+    download(download_dirs)
+    signed = destination_dir / "%7Bsha1%7Dabc"
+    content = signed.read_bytes()
+    assert os.listdir(destination_dir) == ["%7Bsha1%7Dabc"]
+    assert os.listdir(validators_dir) == ["abc"]
+
+    download(download_dirs)
+    url = "https://mdq.example.org/entities/%7Bsha1%7Dabc"
+    assert session.requests == [(url, {}), (url, {"If-None-Match": '"v1"'})]
+    assert signed.read_bytes() == content
+    assert os.listdir(validators_dir) == ["abc"]
+
+
+def test_download_without_validators_removes_sidecar(download_dirs, monkeypatch):
+    destination_dir, validators_dir = download_dirs
+    session = FakeSession(
+        xml_response({"Last-Modified": "Mon, 12 Oct 2026 10:00:00 GMT"}),
+        xml_response({}),
+    )
+    monkeypatch.setattr(mdqp, "_SESSION", session)
+
+    download(download_dirs)
+    assert os.listdir(validators_dir) == ["abc"]
+
+    download(download_dirs)
+    assert session.requests[1][1] == {
+        "If-Modified-Since": "Mon, 12 Oct 2026 10:00:00 GMT"
+    }
+    assert os.listdir(destination_dir) == ["%7Bsha1%7Dabc"]
+    assert os.listdir(validators_dir) == []
+
+
+def test_download_ignores_corrupt_sidecar(download_dirs, monkeypatch):
+    destination_dir, validators_dir = download_dirs
+    (destination_dir / "%7Bsha1%7Dabc").write_text("signed")
+    (validators_dir / "abc").write_text('{"If-None-Match": ')
+    session = FakeSession(xml_response({"ETag": '"v2"'}))
+    monkeypatch.setattr(mdqp, "_SESSION", session)
+
+    download(download_dirs)
+    assert session.requests[0][1] == {}
+    sidecar = json.loads((validators_dir / "abc").read_text())
+    assert sidecar == {"If-None-Match": '"v2"'}
+
+
+def test_download_invalid_xml_leaves_no_temporary_file(download_dirs, monkeypatch):
+    destination_dir, validators_dir = download_dirs
+    session = FakeSession(xml_response({"ETag": '"v1"'}, b"<EntityDescriptor"))
+    monkeypatch.setattr(mdqp, "_SESSION", session)
+
+    with pytest.raises(SystemExit, match="invalid XML"):
+        download(download_dirs)
+    assert os.listdir(destination_dir) == []
+    assert os.listdir(validators_dir) == []